@@ -1,28 +1,32 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field, field_validator
 import httpx
-import io
 import os
 import tempfile
-from datetime import datetime, timedelta
-import uuid
 import shutil
-from typing import Optional, Dict
+from typing import Optional, List, Tuple
 import asyncio
+import logging
+import heapq
+import time
 from pathlib import Path
+from urllib.parse import quote_plus
 
-app = FastAPI(title="Markdown to PDF Converter")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Markdown to PDF Converter", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
+    allow_credentials=False,  # No cookies/auth used, so a static "*" header is sent
+    allow_methods=["GET", "POST"],  # Only the methods the API uses
+    allow_headers=["content-type", "accept"],  # Only the headers the API reads
 )
 
 # Create temporary directory for PDFs
@@ -32,271 +36,212 @@ os.makedirs(TEMP_PDF_DIR, exist_ok=True)
 # Create static directory for serving PDF files
 PDF_DIR = "static/pdfs"
 os.makedirs(PDF_DIR, exist_ok=True)
+PDF_DIR_PATH = Path(PDF_DIR)
 
-# Mount static directory
-app.mount("/pdfs", StaticFiles(directory=PDF_DIR), name="pdfs")
-
-# Store PDF files and their expiry times
-pdf_files: Dict[str, datetime] = {}
-
-# Define CSS style once
-PDF_CSS = """
-    body {
-        font-family: Arial, sans-serif;
-        line-height: 1.6;
-        margin: 10px 0;
-        color: #333;
-        padding: 0;
-    }
-
-    .content-wrapper {
-        max-width: 100%;
-        margin: 0;
-        padding: 0;
-    }
-
-    p {
-        font-size: 17px;
-        margin-bottom: 12px;
-        text-align: justify;
-        color: #333;
-        padding: 0;
-    }
-
-    h1 {
-        font-size: 36px;
-        font-weight: 800;
-        color: #1e3a8a;
-        margin: 0 0 20px 0;
-        padding: 0 0 8px 0;
-        border-bottom: 2px solid #1e3a8a;
-        line-height: 1.2;
-    }
-
-    h2 {
-        font-size: 28px;
-        font-weight: 700;
-        color: #1e40af;
-        margin: 20px 0 12px 0;
-        line-height: 1.2;
-    }
-
-    h3 {
-        font-size: 22px;
-        font-weight: 600;
-        color: #333;
-        margin: 16px 0 6px 0;
-        line-height: 1.2;
-    }
+# Public URL prefix for saved PDFs when PDF_DIR is served by a reverse proxy
+# or CDN instead of the app (e.g. https://example.com/pdfs)
+PDF_BASE_URL = os.getenv("PDF_BASE_URL", "").rstrip("/")
 
-    h4 {
-        font-size: 20px;
-        font-weight: 600;
-        color: #4f46e5;
-        margin: 14px 0 8px 0;
-        line-height: 1.2;
-    }
+# Mount static directory, unless PDFs are served outside the app
+if not PDF_BASE_URL:
+    app.mount("/pdfs", StaticFiles(directory=PDF_DIR), name="pdfs")
 
-    ul, ol {
-        margin-left: 16px;
-        margin-bottom: 4px;
-        padding-left: 12px;
-        line-height: 1.1;
-    }
+# Saved PDF files as a min-heap of (expiry epoch time, filename)
+pdf_expiry_heap: List[Tuple[float, str]] = []
 
-    li {
-        margin-bottom: 4px;
-        font-size: 17px;
-        color: #333;
-        line-height: 1.7;
-        padding-top: 0;
-        padding-bottom: 0;
-    }
+# How long saved PDFs are kept (1 hour)
+PDF_TTL_SECONDS = 3600
 
-    li p {
-        margin: 0;
-        line-height: 1.7;
-    }
+# External markdown-to-PDF conversion service
+MD_TO_PDF_API_URL = "https://md-to-pdf.fly.dev"
 
-    li > ul, li > ol {
-        margin-top: 0px;
-        margin-bottom: 0px;
-        padding-left: 12px;
-    }
+# Limit on conversions in flight at the external API at any one time
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "16"))
+upstream_semaphore = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
 
-    li > ul li, li > ol li {
-        margin-bottom: 0px;
-    }
+# Load CSS style once at startup
+PDF_CSS = Path(__file__).with_name("pdf_style.css").read_text(encoding="utf-8")
 
-    ul:last-child, ol:last-child {
-        margin-bottom: 4px;
-    }
+# Constant tail of the form-encoded body sent to the external API,
+# url-encoded once here rather than on every request
+PDF_FORM_SUFFIX = b"&engine=wkhtmltopdf&css=" + quote_plus(PDF_CSS).encode()
 
-    table {
-        width: 100%;
-        border-collapse: collapse;
-        margin: 20px 0;
-    }
-
-    th {
-        background-color: #f8fafc;
-        padding: 12px;
-        text-align: left;
-        font-weight: 600;
-        color: #1e40af;
-        border: 1px solid #e2e8f0;
-    }
-
-    td {
-        padding: 12px;
-        border: 1px solid #e2e8f0;
-        color: #333;
-    }
-
-    code {
-        background-color: #f1f5f9;
-        padding: 2px 4px;
-        border-radius: 4px;
-        font-family: monospace;
-        font-size: 14px;
-    }
-
-    pre code {
-        display: block;
-        padding: 12px;
-        margin: 16px 0;
-        overflow-x: auto;
-    }
-"""
+# Maximum markdown size accepted for conversion (100KB)
+MAX_MARKDOWN_BYTES = 100_000
 
 class MarkdownRequest(BaseModel):
-    text: str
+    # Validated while the request body is parsed, so oversized markdown is
+    # rejected with a 422 before the handler runs
+    text: str = Field(max_length=MAX_MARKDOWN_BYTES)
+
+    @field_validator("text")
+    @classmethod
+    def check_encoded_size(cls, value: str) -> str:
+        """Enforce the limit on UTF-8 bytes, not just characters."""
+        size = len(value.encode("utf-8"))
+        if size > MAX_MARKDOWN_BYTES:
+            raise ValueError(f"Markdown content too large: {size} bytes. Maximum allowed is 100KB.")
+        return value
 
 async def cleanup_old_files():
     """Clean up expired PDF files."""
     while True:
-        current_time = datetime.now()
-        # Check each file
-        expired_files = [
-            filename for filename, expiry_time in pdf_files.items()
-            if current_time > expiry_time
-        ]
+        if not pdf_expiry_heap:
+            # Nothing saved yet, check again in 10 minutes
+            await asyncio.sleep(600)
+            continue
+        
+        # Sleep until the earliest file expires. Every file gets the same TTL,
+        # so files saved meanwhile never expire before the current head.
+        await asyncio.sleep(max(0.0, pdf_expiry_heap[0][0] - time.time()))
         
         # Remove expired files
-        for filename in expired_files:
-            file_path = os.path.join(PDF_DIR, filename)
+        current_time = time.time()
+        while pdf_expiry_heap and pdf_expiry_heap[0][0] <= current_time:
+            _, filename = heapq.heappop(pdf_expiry_heap)
             try:
-                os.remove(file_path)
-                del pdf_files[filename]
-            except (OSError, KeyError):
+                os.unlink(PDF_DIR_PATH / filename)
+            except OSError:
                 pass
-        
-        # Run every 10 minutes
-        await asyncio.sleep(600)
 
 @app.on_event("startup")
 async def startup_event():
-    """Start the cleanup task when the app starts."""
+    """Start the cleanup task and the shared HTTP client when the app starts."""
+    # One pooled HTTP/2 client for the lifetime of the app so connections (and
+    # their TLS sessions) to the external API are reused and multiplexed
+    app.state.http_client = httpx.AsyncClient(
+        base_url=MD_TO_PDF_API_URL,
+        http2=True,
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=32,
+            max_connections=256,
+            keepalive_expiry=60,
+        ),
+    )
     asyncio.create_task(cleanup_old_files())
 
-async def save_pdf_get_url(pdf_content: bytes, request: Request) -> str:
-    """Save PDF content and return its URL."""
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the shared HTTP client when the app stops."""
+    await app.state.http_client.aclose()
+
+async def save_pdf_get_url(response: httpx.Response, request: Request) -> str:
+    """Save the streamed PDF from the external API and return its URL."""
     # Generate unique filename
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"doc_{timestamp}_{uuid.uuid4().hex[:8]}.pdf"
-    filepath = os.path.join(PDF_DIR, filename)
+    now = time.time()
+    filename = f"doc_{int(now)}_{os.urandom(4).hex()}.pdf"
+    filepath = PDF_DIR_PATH / filename
+    partpath = filepath.with_suffix(".part")
     
-    # Save the file
-    with open(filepath, "wb") as f:
-        f.write(pdf_content)
+    # Write each chunk as it arrives, in a worker thread so disk writes don't
+    # block the event loop, under a temporary name until the PDF is complete
+    try:
+        f = await asyncio.to_thread(open, partpath, "wb")
+        try:
+            size = 0
+            async for chunk in response.aiter_bytes():
+                await asyncio.to_thread(f.write, chunk)
+                size += len(chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        logger.debug("Received PDF content with size: %d bytes", size)
+        os.replace(partpath, filepath)
+    except BaseException:
+        # Don't leave a partial PDF behind that the cleanup task never sees
+        try:
+            os.unlink(partpath)
+        except OSError:
+            pass
+        raise
     
     # Set expiry (1 hour from now)
-    pdf_files[filename] = datetime.now() + timedelta(hours=1)
+    heapq.heappush(pdf_expiry_heap, (now + PDF_TTL_SECONDS, filename))
     
     # Construct the full URL
+    if PDF_BASE_URL:
+        return f"{PDF_BASE_URL}/{filename}"
     return f"{request.base_url}pdfs/{filename}"
 
-@app.post("/text-input")
-async def text_input_to_pdf(request: Request, markdown_req: MarkdownRequest):
+async def convert_markdown_to_pdf(markdown: str, request: Request):
+    """Convert markdown via the external API and return the PDF or its URL."""
+    # Prepare the form data (only the markdown needs encoding per request)
+    form_body = b"markdown=" + quote_plus(markdown).encode() + PDF_FORM_SUFFIX
+
+    # Make the request to the external API
+    client = app.state.http_client
+    logger.debug("Sending request to external API: %s", MD_TO_PDF_API_URL)
     try:
-        # Log the request details
-        print(f"Received markdown request with text length: {len(markdown_req.text)}")
+        # Log the first 100 characters of the markdown for debugging
+        logger.debug("Markdown preview: %.100s...", markdown)
         
-        # Check if the markdown content is too large
-        if len(markdown_req.text) > 100000:  # 100KB limit
-            print(f"Markdown content too large: {len(markdown_req.text)} bytes")
+        # Send without reading the body so the PDF can be streamed onwards
+        upstream_request = client.build_request(
+            "POST",
+            "/",
+            content=form_body,
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        # Wait for a free slot rather than piling more work onto the external API
+        async with upstream_semaphore:
+            response = await client.send(upstream_request, stream=True)
+        
+        logger.debug("External API response status: %s", response.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("External API response headers: %s", dict(response.headers))
+        
+        if response.status_code != 200:
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            error_detail = f"External API error: {response.text}"
+            logger.error("Error from external API: %s", error_detail)
             raise HTTPException(
-                status_code=400,
-                detail=f"Markdown content too large: {len(markdown_req.text)} bytes. Maximum allowed is 100KB."
+                status_code=response.status_code,
+                detail=error_detail
             )
         
-        # Prepare the form data
-        form_data = {
-            "markdown": markdown_req.text,
-            "engine": "wkhtmltopdf",
-            "css": PDF_CSS
-        }
-
-        # Make the request to the external API
-        async with httpx.AsyncClient() as client:
-            print(f"Sending request to external API: https://md-to-pdf.fly.dev")
+        # Return the URL of the saved PDF
+        if request.headers.get("accept") == "application/json":
+            # Save PDF and get URL
             try:
-                # Log the first 100 characters of the markdown for debugging
-                print(f"Markdown preview: {markdown_req.text[:100]}...")
-                
-                response = await client.post(
-                    "https://md-to-pdf.fly.dev",
-                    data=form_data,
-                    headers={"Content-Type": "application/x-www-form-urlencoded"},
-                    timeout=30.0  # Add a timeout
-                )
-                
-                print(f"External API response status: {response.status_code}")
-                print(f"External API response headers: {dict(response.headers)}")
-                
-                if response.status_code != 200:
-                    error_detail = f"External API error: {response.text}"
-                    print(f"Error from external API: {error_detail}")
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=error_detail
-                    )
-                
-                # Get the PDF content
-                pdf_content = response.content
-                print(f"Received PDF content with size: {len(pdf_content)} bytes")
-                
-                # Save PDF and get URL
-                pdf_url = await save_pdf_get_url(pdf_content, request)
-                print(f"Saved PDF and generated URL: {pdf_url}")
-                
-                # Return both the direct PDF and the URL
-                if request.headers.get("accept") == "application/json":
-                    return JSONResponse({
-                        "pdf_url": pdf_url,
-                        "message": "PDF generated successfully"
-                    })
-                else:
-                    # Return the PDF directly as before
-                    return StreamingResponse(
-                        io.BytesIO(pdf_content),
-                        media_type="application/pdf",
-                        headers={
-                            "Content-Disposition": "attachment; filename=converted.pdf"
-                        }
-                    )
-            except httpx.RequestError as e:
-                print(f"Request error to external API: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Request error to external API: {str(e)}")
-            except httpx.TimeoutException as e:
-                print(f"Timeout error to external API: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Timeout error to external API: {str(e)}")
+                pdf_url = await save_pdf_get_url(response, request)
+            finally:
+                await response.aclose()
+            logger.debug("Saved PDF and generated URL: %s", pdf_url)
+            
+            return ORJSONResponse({
+                "pdf_url": pdf_url,
+                "message": "PDF generated successfully"
+            })
+        else:
+            # Stream the PDF directly from the external API to the client
+            return StreamingResponse(
+                response.aiter_bytes(),
+                media_type="application/pdf",
+                headers={
+                    "Content-Disposition": "attachment; filename=converted.pdf"
+                },
+                background=BackgroundTask(response.aclose)
+            )
+    except httpx.RequestError as e:
+        logger.error("Request error to external API: %s", e)
+        raise HTTPException(status_code=500, detail=f"Request error to external API: {str(e)}")
+    except httpx.TimeoutException as e:
+        logger.error("Timeout error to external API: %s", e)
+        raise HTTPException(status_code=500, detail=f"Timeout error to external API: {str(e)}")
+
+@app.post("/text-input")
+async def text_input_to_pdf(request: Request, markdown_req: MarkdownRequest):
+    try:
+        # Log the request details (size limit is enforced by MarkdownRequest)
+        logger.debug("Received markdown request with text length: %d", len(markdown_req.text))
+        
+        return await convert_markdown_to_pdf(markdown_req.text, request)
 
     except Exception as e:
-        import traceback
-        error_traceback = traceback.format_exc()
-        print(f"Error in text_input_to_pdf: {str(e)}")
-        print(f"Traceback: {error_traceback}")
+        logger.exception("Error in text_input_to_pdf: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @app.get("/")